@@ -1,9 +1,7 @@
 from typing import List, Union
 
-import io
 import json
 from pathlib import Path
-import re
 from urllib.request import Request, urlopen
 import shlex
 import subprocess
@@ -41,36 +39,29 @@ class DiscordStatusBuilder:
                 "filename": filename,
             }
         )
-        out = io.BytesIO()
-        out.write(
-            f'Content-Disposition: form-data; name="files[{index}]"; filename="{filename}"\r\n'.encode()
-        )
-        out.write(f"Content-Type: {content_type}\r\n\r\n".encode())
-        out.write(contents.encode() if isinstance(contents, str) else contents)
-        self.parts.append(out.getvalue())
+        header = (
+            f'Content-Disposition: form-data; name="files[{index}]"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        body = contents.encode() if isinstance(contents, str) else contents
+        self.parts.append(header + body)
 
     def generate(self) -> bytes:
         CRLF = b"\r\n"
         payload_json = json.dumps(self.payload)
-        part_out = io.BytesIO()
-        part_out.write(
-            'Content-Disposition: form-data; name="payload_json"\r\n'.encode()
-        )
-        part_out.write("Content-Type: application/json\r\n\r\n".encode())
-        part_out.write(payload_json.encode())
-        self.parts.insert(0, part_out.getvalue())
-
-        out = io.BytesIO()
-        for i, part in enumerate(self.parts):
-            if i > 0:
-                out.write(CRLF)
-            out.write(f"--{BOUNDARY}".encode())
-            out.write(CRLF)
-            out.write(part)
-        out.write(CRLF)
-        out.write(f"--{BOUNDARY}--".encode())
-        out.write(CRLF)
-        return out.getvalue()
+        payload_part = (
+            'Content-Disposition: form-data; name="payload_json"\r\n'
+            "Content-Type: application/json\r\n\r\n"
+            f"{payload_json}"
+        ).encode()
+
+        # Collect the pieces and join once rather than copying through a buffer.
+        delimiter = f"--{BOUNDARY}".encode()
+        chunks = []
+        for part in [payload_part] + self.parts:
+            chunks.extend((delimiter, CRLF, part, CRLF))
+        chunks.extend((f"--{BOUNDARY}--".encode(), CRLF))
+        return b"".join(chunks)
 
     def post(self):
         webhook_path = repo_path / ".discord_webhook"
@@ -152,6 +143,15 @@ def git_fetch(*, repository=None, ref=None, repo_dir=None):
     git_exec(args, repo_dir=repo_dir)
 
 
+def git_fetch_multiple(repositories, *, jobs=None, repo_dir=None):
+    # Fetches several remotes with one git process, in parallel if jobs > 1.
+    args = ["fetch", "--multiple"]
+    if jobs is not None:
+        args.append(f"--jobs={jobs}")
+    args.extend(repositories)
+    git_exec(args, repo_dir=repo_dir)
+
+
 def git_checkout(ref, *, repo_dir=None):
     git_exec(["checkout", ref], repo_dir=repo_dir)
 
@@ -173,7 +173,8 @@ def git_create_branch(
 ):
     if not force:
         git_check_if_branch_exists(branch_name)
-        git_check_if_branch_exists(branch_name, remote=remote)
+        if remote is not None:
+            git_check_if_branch_exists(branch_name, remote=remote)
     branch_args = ["branch"]
     if force:
         branch_args.append("-f")
@@ -195,14 +196,15 @@ def git_push_branch(repository, branch_name, *, force=False, repo_dir=None):
     git_exec(push_args, repo_dir=repo_dir)
 
 
-def git_branch_exists(branch_name, *, repo_dir=None):
+def git_list_branches(pattern, *, repo_dir=None) -> List[str]:
+    # Lists local branch names matching the glob pattern with one git call.
     output = git_exec(
-        ["branch", "-l", branch_name],
+        ["for-each-ref", "--format=%(refname:lstrip=2)", f"refs/heads/{pattern}"],
         repo_dir=repo_dir,
         quiet=True,
         capture_output=True,
-    ).strip()
-    return bool(output)
+    )
+    return output.splitlines()
 
 
 def git_submodule_set_origin(path, *, url=None, branch=None, repo_dir=None):
@@ -248,9 +250,9 @@ def git_current_commit(*, repo_dir=None) -> Tuple[str, str]:
         quiet=True,
     )
     output = output.strip()
-    parts = output.split(" ")
+    commit = output.split(" ", maxsplit=1)[0]
     # Return commit, full_summary
-    return parts[0], output
+    return commit, output
 
 
 def git_commit_summary(ref, repo_dir=None) -> str:
@@ -295,23 +297,26 @@ def git_create_commit(*, message, add_all=False, repo_dir=None):
     git_exec(["commit", "-m", message], repo_dir=repo_dir)
 
 
+# `git ls-remote` line format is <commit> refs/heads/branch_name
+def _ls_remote_commit(line):
+    return line.split()[0]
+
+
+def _ls_remote_branch(line):
+    ref = line.split()[1]
+    prefix = "refs/heads/"
+    if ref.startswith(prefix):
+        ref = ref[len(prefix) :]
+    return ref
+
+
 def git_ls_remote_branches(repository_url, *, filter=None, repo_dir=None):
     args = ["ls-remote", "-h", repository_url]
     if filter:
         args.extend(filter)
     output = git_exec(args, quiet=True, capture_output=True)
     lines = output.strip().splitlines(keepends=False)
-
-    # Format is <commit> refs/heads/branch_name
-    def extract_branch(line):
-        parts = re.split("\\s+", line)
-        ref = parts[1]
-        prefix = "refs/heads/"
-        if ref.startswith(prefix):
-            ref = ref[len(prefix) :]
-        return ref
-
-    return [extract_branch(l) for l in lines]
+    return [_ls_remote_branch(l) for l in lines]
 
 
 def git_remote_head(remote: str, head: str, repo_dir=None) -> Optional[str]:
@@ -321,13 +326,7 @@ def git_remote_head(remote: str, head: str, repo_dir=None) -> Optional[str]:
     lines = output.strip().splitlines(keepends=False)
     if not lines:
         return None
-
-    def extract_commit(line):
-        parts = re.split("\\s+", line)
-        commit = parts[0]
-        return commit
-
-    return next(extract_commit(l) for l in lines)
+    return _ls_remote_commit(lines[0])
 
 
 def git_current_branch(*, repo_dir=None):
@@ -357,11 +356,106 @@ def check_origin_update_help(repo_dir):
     return True
 
 
+def export_submodule_head(
+    super_repo_path: Path, submodule_rel_path: str, *, submodule_branch=None
+):
+    """Persists the current submodule head on a topic branch of its origin.
+
+    If the submodule commit is not upstream, it is pushed (or spliced) onto
+    `sm-{super_repo_name}-{super_branch}` unless `submodule_branch` is given.
+    """
+    super_repo_name = super_repo_path.name
+    super_branch = git_current_branch(repo_dir=super_repo_path)
+    print(f"Super-repo '{super_repo_name}' is on branch '{super_branch}'")
+    submodule_path = super_repo_path / submodule_rel_path
+    print(f"Operating on submodule {submodule_path}")
+    if not check_origin_update_help(submodule_path):
+        return 1
+    git_fetch(repository="origin", repo_dir=submodule_path)
+    submodule_head, submodule_summary = git_current_commit(repo_dir=submodule_path)
+    print(f"Submodule at {submodule_head}\n  {submodule_summary}")
+    submodule_merge_base = git_merge_base(
+        submodule_head, "origin/main", repo_dir=submodule_path
+    )
+    if submodule_merge_base == submodule_head:
+        print("Submodule commit is upstream. Nothing to do.")
+        return 0
+
+    submodule_branch = submodule_branch or f"sm-{super_repo_name}-{super_branch}"
+    print(
+        f"Submodule merge base {submodule_merge_base} diverges from upstream. Will persist on {submodule_branch}."
+    )
+
+    # Get the remote topic head.
+    remote_topic_head = git_remote_head(
+        "origin", f"refs/heads/{submodule_branch}", repo_dir=submodule_path
+    )
+
+    # Early exit if precisely at this commit.
+    if remote_topic_head == submodule_head:
+        print(f"Submodule branch {submodule_branch} is already at {submodule_head}")
+        return 0
+
+    # If the branch does not exist, just push to it and exit.
+    if not remote_topic_head:
+        print(f"Submodule branch {submodule_branch} does not exist. Pushing.")
+        git_exec(
+            ["push", "origin", f"{submodule_head}:refs/heads/{submodule_branch}"],
+            repo_dir=submodule_path,
+        )
+        print("PLEASE IGNORE ANY NOTICE ABOUT CREATING A PR")
+        return 0
+
+    # Check if the submodule_head is an ancestor of the current remote_topic_head
+    # and exit if so (it is already reachable).
+    try:
+        git_exec(
+            ["merge-base", "--is-ancestor", submodule_head, remote_topic_head],
+            repo_dir=submodule_path,
+        )
+        print(
+            f"Commit {submodule_head} is reachable from remote branch {submodule_branch}. Doing nothing."
+        )
+        return
+    except subprocess.CalledProcessError as e:
+        # If not an ancestor, returncode will be 1. On general error, it will be
+        # something else.
+        if e.returncode != 1:
+            raise
+
+    # Create a splice commit that is based on the tree of the current submodule head
+    # and has parents of the current submodule head and the remote topic head.
+    # Note that the current branch is not touched, the commit is just created in the
+    # ether. We can push it to the remote topic branch to complete the splice.
+    print(f"Submodule head {submodule_head} is not on {submodule_branch}. Splicing.")
+    splice_commit = git_exec(
+        [
+            "commit-tree",
+            submodule_head + "^{tree}",
+            "-p",
+            submodule_head,
+            "-p",
+            remote_topic_head,
+            "-m",
+            f"Splice submodule rebase {submodule_head} onto {remote_topic_head}",
+        ],
+        repo_dir=submodule_path,
+        capture_output=True,
+    ).strip()
+    print(f"Created splice commit {splice_commit}: pushing")
+    git_exec(
+        ["push", "origin", f"{splice_commit}:refs/heads/{submodule_branch}"],
+        repo_dir=submodule_path,
+    )
+
+
 def git_exec(args, *, repo_dir, quiet=False, capture_output=False):
     full_args = ["git"] + args
     full_args_quoted = [shlex.quote(a) for a in full_args]
     if not quiet:
-        print(f"  ++ EXEC: (cd {repo_dir} && {' '.join(full_args_quoted)})")
+        print(
+            f"  ++ EXEC: (cd {repo_dir} && {' '.join(full_args_quoted)})", flush=True
+        )
     if capture_output:
         return subprocess.check_output(full_args, cwd=repo_dir).decode("utf-8")
     else: